@@ -4,18 +4,43 @@ import numpy as np
 import sounddevice as sd
 import threading
 import queue
+from collections import deque
+from dataclasses import dataclass
+from functools import cached_property
 import serial.tools.list_ports
 import serial
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib import cm
+from PIL import Image, ImageTk
+
+# scipy's pocketfft is SIMD-accelerated and multithreaded; numpy.fft is the fallback
+try:
+    import scipy.fft
+
+    def rfft(x, n):
+        return scipy.fft.rfft(x, n, workers=-1)
+
+    next_fast_len = scipy.fft.next_fast_len
+except ImportError:
+    def rfft(x, n):
+        return np.fft.rfft(x, n)
+
+    def next_fast_len(n):
+        return n
 
 # Constants for RTTY
 FS = 44100
-baud_rate = 45.45
-BIT_LEN = int(FS / baud_rate)
 MARK = 2125
-SHIFT = 170
 STOP_BITS = 2
+RX_RING_LEN = 1 << 15
+WF_FFT_LEN = 1024
+WF_NFFT = next_fast_len(WF_FFT_LEN)
+WF_HAMMING = np.hamming(WF_FFT_LEN).astype(np.float32)
+WF_INTERVAL_MS = 150
+TX_BLOCK = 16384
+RX_FLUSH_MS = 50
+
+# inferno colormap as a 256-entry RGB lookup table for the waterfall
+CMAP = (cm.inferno(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
 
 # Baudot code mappings
 baudot = {
@@ -27,7 +52,17 @@ baudot = {
     'U': 0b00111, 'V': 0b11110, 'W': 0b10011, 'X': 0b11101,
     'Y': 0b10101, 'Z': 0b10001, ' ': 0b00100
 }
-rev_baudot = {v: k for k, v in baudot.items()}
+# 5-bit code -> ASCII lookup table, '?' for codes with no letter
+REV_BAUDOT = np.full(32, ord('?'), dtype=np.uint8)
+for c, v in baudot.items():
+    REV_BAUDOT[v] = ord(c)
+
+# ASCII -> start bit, 5 data bits (LSB first) and stop bits; unknown chars send 0
+BITS_TABLE = np.zeros((128, 6 + STOP_BITS), dtype=np.int8)
+for code in range(128):
+    v = baudot.get(chr(code).upper(), 0)
+    BITS_TABLE[code, 1:6] = [(v >> i) & 1 for i in range(5)]
+BITS_TABLE[:, 6:] = 1
 
 # Globals for devices and PTT
 input_device = None
@@ -38,91 +73,174 @@ ptt_enabled = False
 
 # Audio queues
 rx_queue = queue.Queue()
-fft_queue = queue.Queue()
 
 # --- Helper functions for audio ---
 
-def generate_tone(frequency, duration_sec, volume=0.5):
-    t = np.arange(int(FS * duration_sec)) / FS
-    return volume * np.sin(2 * np.pi * frequency * t)
-
-def transmit_rtty(text, volume=0.5):
-    global output_device
-    bit_time = 1 / baud_rate
-    stream = sd.OutputStream(samplerate=FS, device=output_device, channels=1)
-    stream.start()
-
-    def char_to_bits(c):
-        val = baudot.get(c.upper(), 0)
-        bits = [0]  # Start bit
-        for i in range(5):
-            bits.append((val >> i) & 1)
-        for _ in range(STOP_BITS):
-            bits.append(1)
-        return bits
-
-    for c in text:
-        bits = char_to_bits(c)
-        for bit in bits:
-            freq = MARK if bit == 1 else MARK - SHIFT
-            tone = generate_tone(freq, bit_time, volume)
-            stream.write(tone.astype(np.float32))
-    stream.stop()
-    stream.close()
+@dataclass(frozen=True)
+class RadioParams:
+    # Everything derived from the modem settings is built lazily, once per
+    # instance. Settings changes swap in a new instance instead of mutating
+    # globals, and each thread reads current_params once per block of work.
+    fs: int
+    baud: float
+    shift: int
+
+    @cached_property
+    def bit_len(self):
+        return int(self.fs / self.baud)
+
+    @cached_property
+    def detector_ref(self):
+        # (bit_len, 2) phasors for the mark and space Goertzel bins
+        w = 2 * np.pi * np.array([MARK, MARK - self.shift]) / self.fs
+        n = np.arange(self.bit_len)[:, None]
+        return np.exp(-1j * w * n).astype(np.complex64)
+
+    @cached_property
+    def tx_w(self):
+        # Angular step per sample, indexed by bit value (0 = space, 1 = mark)
+        return 2 * np.pi * np.array([MARK - self.shift, MARK]) / self.fs
+
+    @cached_property
+    def tx_waves(self):
+        # (2, bit_len) NCO phasor segments step**n, indexed by bit value
+        n = np.arange(self.bit_len)
+        return np.exp(1j * self.tx_w[:, None] * n).astype(np.complex64)
+
+    @cached_property
+    def tx_advance(self):
+        # Phase each tone advances over one whole bit
+        return (self.tx_w * self.bit_len) % (2 * np.pi)
+
+current_params = RadioParams(fs=FS, baud=45.45, shift=170)
+
+def transmit_rtty(stream, text, volume=0.5):
+    params = current_params
+
+    codes = np.frombuffer(text.encode('ascii', 'replace'), dtype=np.uint8)
+    bits = BITS_TABLE[codes].ravel()
+    # Start each bit at the phase the previous bits left off at, so tone
+    # changes don't click, then gather and rotate all segments in one go
+    start = np.concatenate(([0.0], np.cumsum(params.tx_advance[bits])[:-1]))
+    phasors = np.exp(1j * start).astype(np.complex64)
+    out = (params.tx_waves[bits] * phasors[:, None]).imag.ravel()
+    out *= volume
+
+    for i in range(0, len(out), TX_BLOCK):
+        stream.write(out[i:i + TX_BLOCK])
+    # The stream stays open, so wait for the buffered tail to play out
+    sd.sleep(int(stream.latency * 1000))
+
+class RingBuffer:
+    # Fixed-size circular float32 sample buffer with read/write cursors.
+    # If the reader falls a whole ring behind, the oldest samples are dropped.
+    # write() and latest() are locked so another thread can watch the stream.
+    def __init__(self, size):
+        self._ring = np.empty(size, dtype=np.float32)
+        self._read = 0
+        self._write = 0
+        self._lock = threading.Lock()
+
+    def available(self):
+        return self._write - self._read
+
+    def written(self):
+        return self._write
+
+    def write(self, data):
+        size = len(self._ring)
+        data = data[-size:]
+        with self._lock:
+            start = self._write % size
+            first = min(len(data), size - start)
+            np.copyto(self._ring[start:start + first], data[:first])
+            np.copyto(self._ring[:len(data) - first], data[first:])
+            self._write += len(data)
+            if self._write - self._read > size:
+                self._read = self._write - size
+
+    def peek(self, n):
+        # Next n unread samples; only copies when they straddle the wrap
+        size = len(self._ring)
+        start = self._read % size
+        end = start + n
+        if end <= size:
+            return self._ring[start:end]
+        return np.concatenate((self._ring[start:], self._ring[:end - size]))
+
+    def consume(self, n):
+        self._read += n
+
+    def latest(self, n):
+        # Copy of the n most recently written samples
+        with self._lock:
+            end = self._write % len(self._ring)
+            if n <= end:
+                return self._ring[end - n:end].copy()
+            return np.concatenate((self._ring[end - n:], self._ring[:end]))
+
+# Recent RX audio shared with the waterfall display
+wf_ring = RingBuffer(RX_RING_LEN)
 
 def rx_callback(indata, frames, time, status):
     if status:
         print(status)
-    data = indata[:, 0].copy()
-    rx_queue.put(data)
-    # Calculate FFT for waterfall display
-    fft = np.abs(np.fft.rfft(data * np.hamming(len(data))))
-    fft_queue.put(fft[:512])
+    rx_queue.put(indata[:, 0].copy())
+
+def goertzel2(x, ref):
+    # Goertzel power s1*s1 + s2*s2 - c*s1*s2 for both tones, evaluated in
+    # closed form as |sum x[n]e^-jwn|^2 so it runs as one matvec in C.
+    # Accepts one bit period or an (n_bits, bit_len) block of them.
+    y = np.dot(x, ref)
+    mag = y.real * y.real + y.imag * y.imag
+    return mag[..., 0], mag[..., 1]
+
+# RX state machine states
+RX_IDLE, RX_DATA, RX_STOP = 0, 1, 2
+
+def decode_bits(bits, state, val, count):
+    # Runs the start/data/stop state machine over a block of bits and returns
+    # the completed Baudot codes plus the state to resume from next block.
+    codes = []
+    for bit_val in bits.tolist():
+        if state == RX_IDLE:
+            if bit_val == 0:  # start bit detected
+                state, val, count = RX_DATA, 0, 0
+        elif state == RX_DATA:
+            val |= bit_val << count
+            count += 1
+            if count == 5:
+                state = RX_STOP
+        else:
+            if bit_val == 1:  # stop bit must be 1
+                codes.append(val)
+            state = RX_IDLE
+    return codes, state, val, count
 
 # RX decoding thread
-def rx_process(rx_output_text, scroll_lock_var, status_var):
-    buffer = np.array([])
-    bit_len = BIT_LEN
-    state = 'idle'
-    bits = []
-    sample_counter = 0
+def rx_process(rx_chars):
+    ring = RingBuffer(RX_RING_LEN)
+    state, val, count = RX_IDLE, 0, 0
     while True:
         chunk = rx_queue.get()
         if chunk is None:
             break
-        buffer = np.append(buffer, chunk)
-        while len(buffer) >= bit_len:
-            bit_chunk = buffer[:bit_len]
-            buffer = buffer[bit_len:]
-            # FFT analysis for bit detection
-            fft = np.abs(np.fft.rfft(bit_chunk * np.hamming(len(bit_chunk))))
-            freqs = np.fft.rfftfreq(len(bit_chunk), 1 / FS)
-            mark_idx = np.argmin(np.abs(freqs - MARK))
-            space_idx = np.argmin(np.abs(freqs - (MARK - SHIFT)))
-            bit_val = 1 if fft[mark_idx] > fft[space_idx] else 0
-
-            if state == 'idle':
-                if bit_val == 0:  # start bit detected
-                    bits = []
-                    state = 'data'
-                    sample_counter = 0
-            elif state == 'data':
-                bits.append(bit_val)
-                sample_counter += 1
-                if sample_counter == 5:
-                    state = 'stop'
-            elif state == 'stop':
-                if bit_val == 1:  # stop bit must be 1
-                    val = 0
-                    for i, b in enumerate(bits):
-                        val |= (b << i)
-                    char = rev_baudot.get(val, '?')
-                    def insert_char(c=char):
-                        rx_output_text.insert('end', c)
-                        if not scroll_lock_var.get():
-                            rx_output_text.see('end')
-                    rx_output_text.after(0, insert_char)
-                state = 'idle'
+        wf_ring.write(chunk)
+        params = current_params
+        bit_len = params.bit_len
+        ring.write(chunk)
+        nb = ring.available() // bit_len
+        if nb == 0:
+            continue
+        # Goertzel tone detection for every whole bit in the buffer at once
+        view = ring.peek(nb * bit_len).reshape(nb, bit_len)
+        mag_mark, mag_space = goertzel2(view, params.detector_ref)
+        ring.consume(nb * bit_len)
+        bits = (mag_mark > mag_space).astype(np.int8)
+        codes, state, val, count = decode_bits(bits, state, val, count)
+        if codes:
+            # deque appends are thread-safe; the GUI drains it on a timer
+            rx_chars.append(REV_BAUDOT[codes].tobytes().decode('ascii'))
 
 # PTT control
 def open_ptt_serial(port_name):
@@ -166,20 +284,19 @@ class RTTYApp:
         self.rx_output = tk.Text(self.tab_txrx, height=10)
         self.rx_output.pack(fill='both', expand=1, padx=5, pady=5)
 
-        # Waterfall plot setup
-        self.fig, self.ax = plt.subplots(figsize=(5, 2))
-        self.canvas = FigureCanvasTkAgg(self.fig, master=self.tab_txrx)
-        self.canvas.get_tk_widget().pack(fill='x', padx=5, pady=5)
-        self.ax.set_title("FFT")
-        self.ax.set_ylim(0, 100)
-        self.ax.set_xlim(0, FS/2)
-        self.waterfall_data = np.zeros((100, 512))
-        self.im = self.ax.imshow(self.waterfall_data, aspect='auto', origin='lower',
-                                 extent=[0, FS/2, 0, 100], cmap='inferno')
+        # Waterfall display
+        self.wf_canvas = tk.Canvas(self.tab_txrx, width=512, height=100, highlightthickness=0)
+        self.wf_canvas.pack(padx=5, pady=5)
+        self.wf_photo = ImageTk.PhotoImage('RGB', (512, 100))
+        self.wf_canvas.create_image(0, 0, anchor='nw', image=self.wf_photo)
+        # Waterfall rows form a ring; _head is the row the next FFT overwrites
+        self.waterfall_data = np.zeros((100, 512), dtype=np.float32)
+        self._head = 0
+        self._wf_written = 0
 
      # --- New frequency shift slider ---
         ttk.Label(self.tab_settings, text="Frequency Shift (50-500Hz):").grid(row=7, column=0, sticky='w', padx=5, pady=2)
-        self.shift_var = tk.IntVar(value=SHIFT)
+        self.shift_var = tk.IntVar(value=current_params.shift)
         self.shift_slider = ttk.Scale(self.tab_settings, from_=50, to=500, variable=self.shift_var, orient='horizontal')
         self.shift_slider.grid(row=7, column=1, sticky='ew', padx=5, pady=2)
         self.shift_slider.bind("<ButtonRelease-1>", self.on_shift_change)
@@ -217,7 +334,7 @@ class RTTYApp:
 
         # --- New baud rate selector ---
         ttk.Label(self.tab_settings, text="Baud Rate:").grid(row=6, column=0, sticky='w', padx=5, pady=2)
-        self.baud_rate_var = tk.DoubleVar(value=baud_rate)
+        self.baud_rate_var = tk.DoubleVar(value=current_params.baud)
         baud_rates = [45.45, 50, 75, 100, 110, 300]
         self.baud_rate_combo = ttk.Combobox(self.tab_settings, textvariable=self.baud_rate_var, state='readonly', values=baud_rates)
         self.baud_rate_combo.grid(row=6, column=1, sticky='ew', padx=5, pady=2)
@@ -230,10 +347,21 @@ class RTTYApp:
         self.update_device_lists()
         # Start audio input stream
         self.stream = None
-        self.rx_thread = threading.Thread(target=rx_process, args=(self.rx_output, self.scroll_lock_var, None), daemon=True)
+        self._char_buf = deque()
+        self.rx_thread = threading.Thread(target=rx_process, args=(self._char_buf,), daemon=True)
         self.rx_thread.start()
         self.start_rx_stream()
+        # One output stream for the app's lifetime; the transmit thread
+        # reopens it after a device change or a failure
+        self.tx_stream = None
+        self.tx_reopen = False
+        self.tx_lock = threading.Lock()
+        try:
+            self.start_tx_stream()
+        except Exception as e:
+            messagebox.showerror("Audio Output Error", f"Cannot open output device {output_device}: {e}")
         self.update_waterfall()
+        self._flush_rx_text()
 
     def update_device_lists(self):
         devices = sd.query_devices()
@@ -252,6 +380,8 @@ class RTTYApp:
     def on_output_device_change(self, event):
         global output_device
         output_device = self.output_var.get()
+        # Don't wait on tx_lock here; the next transmit reopens the stream
+        self.tx_reopen = True
 
     def on_serial_port_change(self, event):
         global serial_port_name
@@ -263,56 +393,104 @@ class RTTYApp:
         ptt_enabled = self.ptt_var.get()
 
     def on_baud_rate_change(self, event):
-        global baud_rate, BIT_LEN
-        baud_rate = self.baud_rate_var.get()
-        BIT_LEN = int(FS / baud_rate)
-        print(f"Baud rate set to: {baud_rate} baud, BIT_LEN updated to {BIT_LEN}")
+        global current_params
+        current_params = RadioParams(FS, self.baud_rate_var.get(), current_params.shift)
+        self.restart_rx_stream()
+        print(f"Baud rate set to: {current_params.baud} baud, BIT_LEN updated to {current_params.bit_len}")
 
     def on_shift_change(self, event):
-        global SHIFT
-        SHIFT = int(self.shift_var.get())
-        print(f"Frequency shift set to: {SHIFT} Hz")
+        global current_params
+        current_params = RadioParams(FS, current_params.baud, int(self.shift_var.get()))
+        print(f"Frequency shift set to: {current_params.shift} Hz")
 
     def start_rx_stream(self):
         global input_device
         if self.stream:
             self.stream.stop()
             self.stream.close()
+            self.stream = None
         if input_device is None:
             input_device = sd.default.device[0]
-        self.stream = sd.InputStream(samplerate=FS, device=input_device, channels=1, callback=rx_callback)
+        try:
+            sd.check_input_settings(device=input_device, channels=1, dtype='float32', samplerate=FS)
+        except Exception as e:
+            messagebox.showerror("Audio Input Error", f"Cannot open input device {input_device}: {e}")
+            return
+        # Fixed blocks of whole bit periods keep callbacks evenly spaced
+        self.stream = sd.InputStream(samplerate=FS, device=input_device, channels=1, dtype='float32',
+                                     blocksize=4 * current_params.bit_len, latency='low', callback=rx_callback)
         self.stream.start()
 
     def restart_rx_stream(self):
         self.start_rx_stream()
 
+    def start_tx_stream(self):
+        # Raises if the device can't be opened; callers report the error
+        if self.tx_stream:
+            self.tx_stream.stop()
+            self.tx_stream.close()
+            self.tx_stream = None
+        sd.check_output_settings(device=output_device, channels=1, dtype='float32', samplerate=FS)
+        self.tx_stream = sd.OutputStream(samplerate=FS, device=output_device, channels=1, dtype='float32', blocksize=0)
+        self.tx_stream.start()
+
     def update_waterfall(self):
-        # Pull all FFT data from queue and update waterfall
-        updated = False
-        try:
-            while True:
-                fft = fft_queue.get_nowait()
-                self.waterfall_data = np.roll(self.waterfall_data, -1, axis=0)
-                self.waterfall_data[-1, :] = fft
-                updated = True
-        except queue.Empty:
-            pass
-        if updated:
-            self.im.set_data(self.waterfall_data)
-            self.im.set_clim(np.min(self.waterfall_data), np.max(self.waterfall_data))
-            self.canvas.draw()
-        self.root.after(100, self.update_waterfall)
+        # One FFT of the most recent RX audio per tick, off the audio thread.
+        # Audio that arrived between ticks is coalesced into that one row.
+        written = wf_ring.written()
+        if written != self._wf_written and written >= WF_FFT_LEN:
+            self._wf_written = written
+            data = wf_ring.latest(WF_FFT_LEN)
+            fft = np.abs(rfft(data * WF_HAMMING, WF_NFFT))
+            self.waterfall_data[self._head] = fft[:512]
+            self._head = (self._head + 1) % len(self.waterfall_data)
+            # Newest row at the top, then scale to 0..255 and colour via the LUT
+            rows = np.concatenate((self.waterfall_data[self._head:],
+                                   self.waterfall_data[:self._head]), axis=0)[::-1]
+            lo, hi = rows.min(), rows.max()
+            u8 = np.clip((rows - lo) * (255 / max(hi - lo, 1e-12)), 0, 255).astype(np.uint8)
+            self.wf_photo.paste(Image.fromarray(CMAP[u8]))
+        self.root.after(WF_INTERVAL_MS, self.update_waterfall)
+
+    def _flush_rx_text(self):
+        # One Text insert for everything decoded since the last flush
+        chars = []
+        while self._char_buf:
+            chars.append(self._char_buf.popleft())
+        if chars:
+            self.rx_output.insert('end', ''.join(chars))
+            if not self.scroll_lock_var.get():
+                self.rx_output.see('end')
+        self.root.after(RX_FLUSH_MS, self._flush_rx_text)
 
     def transmit(self):
         text = self.tx_input.get("1.0", "end").strip()
         if not text:
             return
-        set_ptt(True)
-        threading.Thread(target=self._transmit_thread, args=(text,), daemon=True).start()
-
-    def _transmit_thread(self, text):
-        transmit_rtty(text, volume=self.volume_var.get())
-        set_ptt(False)
+        threading.Thread(target=self._transmit_thread, args=(text, self.volume_var.get()), daemon=True).start()
+
+    def _transmit_thread(self, text, volume):
+        # Back-to-back transmits queue on the lock rather than interleave
+        with self.tx_lock:
+            try:
+                if self.tx_reopen or self.tx_stream is None:
+                    self.tx_reopen = False
+                    self.start_tx_stream()
+            except Exception as e:
+                self.report_tx_error(f"Cannot open output device {output_device}: {e}")
+                return
+            set_ptt(True)
+            try:
+                transmit_rtty(self.tx_stream, text, volume=volume)
+            except Exception as e:
+                # e.g. the device was unplugged; reopen on the next transmit
+                self.tx_reopen = True
+                self.report_tx_error(f"Transmit failed: {e}")
+            finally:
+                set_ptt(False)
+
+    def report_tx_error(self, message):
+        self.root.after(0, lambda: messagebox.showerror("Audio Output Error", message))
 
 def main():
     root = tk.Tk()